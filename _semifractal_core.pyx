@@ -0,0 +1,84 @@
+# cython: boundscheck=False, wraparound=False, cdivision=True
+# cython: language_level=3
+'''
+A C version of `semifractal.build_grid`, which semifractal uses in its
+place once compiled with `cythonize -i _semifractal_core.pyx`.
+'''
+import numpy as np
+
+# The number of wedge rows grown before they are rotated into the grid.
+cdef Py_ssize_t TILE_ROWS = 64
+
+cdef inline void _set_bit(unsigned char[:, ::1] packed,
+                          Py_ssize_t x, Py_ssize_t y) noexcept nogil:
+    packed[y, x >> 3] |= 1 << (x & 7)
+
+cdef void _step(int number, unsigned char[::1] prev, Py_ssize_t width,
+                unsigned char[::1] out) noexcept nogil:
+    # Slides a three-cell window along `prev`, as `semifractal._step` does.
+    cdef Py_ssize_t i
+    cdef int left = 0, center = 0, right
+    for i in range(width + 2):
+        right = prev[i] if i < width else 0
+        out[i] = (number >> ((left << 2) | (center << 1) | right)) & 1
+        left = center
+        center = right
+
+cdef void _fold_tile(unsigned char[:, ::1] tile, Py_ssize_t rows,
+                     Py_ssize_t start,
+                     unsigned char[:, ::1] out) noexcept nogil:
+    cdef Py_ssize_t center = out.shape[0] // 2
+    cdef Py_ssize_t last = start + rows - 1
+    cdef Py_ssize_t r, i, index, raw_y
+    # Two rotations turn each wedge row into a row of the grid...
+    for r in range(rows):
+        index = start + r
+        for i in range(index * 2 + 1):
+            if tile[r, i]:
+                raw_y = i - index
+                _set_bit(out, center - raw_y, center + index)
+                _set_bit(out, center + raw_y, center - index)
+    # ...and two turn it into a column, written a grid row at a time.
+    for raw_y in range(-last, last + 1):
+        for r in range(rows):
+            index = start + r
+            if -index <= raw_y <= index and tile[r, raw_y + index]:
+                _set_bit(out, center + index, center + raw_y)
+                _set_bit(out, center - index, center - raw_y)
+
+cdef void _build(int number, const unsigned char[:, ::1] keep, bint masked,
+                 unsigned char[:, ::1] tile, unsigned char[::1] prev,
+                 unsigned char[:, ::1] out) noexcept nogil:
+    cdef Py_ssize_t n = (out.shape[0] + 1) // 2
+    cdef Py_ssize_t start = 0
+    cdef Py_ssize_t rows, r, i, index
+    while start < n:
+        rows = min(TILE_ROWS, n - start)
+        for r in range(rows):
+            index = start + r
+            if index == 0:
+                tile[0, 0] = 1
+                continue
+            if r:
+                _step(number, tile[r - 1], index * 2 - 1, tile[r])
+            else:
+                _step(number, prev, index * 2 - 1, tile[r])
+            if masked:
+                for i in range(index * 2 + 1):
+                    tile[r, i] &= keep[index, i]
+        prev[:] = tile[rows - 1]
+        _fold_tile(tile, rows, start, out)
+        start += TILE_ROWS
+
+def build(int number, const unsigned char[:, ::1] keep,
+          unsigned char[:, ::1] out):
+    '''Grows the wedge of Wolfram rule `number` and writes it, rotated
+    four times, into the bit-packed square `out`, exactly as
+    `semifractal.build_grid` does. `keep` may be `None`.'''
+    cdef Py_ssize_t size = out.shape[0]
+    cdef unsigned char[:, ::1] tile = np.zeros((TILE_ROWS, size),
+                                               dtype=np.uint8)
+    cdef unsigned char[::1] prev = np.zeros(size, dtype=np.uint8)
+    cdef bint masked = keep is not None
+    with nogil:
+        _build(number, keep, masked, tile, prev, out)
@@ -5,77 +5,272 @@ based on an initial seed and any acceptable 1-d cellular automata
 algorithm.
 '''
 import sys
-import random
 import time
+import threading
+import collections
+import hashlib
+import operator
+import queue
+import concurrent.futures
+import numpy as np
 import pygame
+from numba import cuda, njit, prange
+try:
+    # The optional C version of `build_grid`; see _semifractal_core.pyx.
+    from _semifractal_core import build as _build_native
+except ImportError:
+    _build_native = None
+
+# Rule 150 in Wolfram's encoding: entry `(left << 2) | (center << 1) | right`
+# holds the colour of the cell below that neighbourhood.
+RULE150_LUT = np.array([int(bin(i).count('1') & 1) for i in range(8)],
+                       dtype=np.uint8)
+
+# Writes the row below `prev` into `out`, which is two cells wider, under
+# Wolfram rule `number`; cell `i` of `out` sits below cells `i - 2`, `i - 1`
+# and `i` of `prev`, so the kernel slides a three-cell window along `prev`.
+@njit(cache=True)
+def _step(prev, out, number):
+    width = prev.size
+    left = center = 0
+    for i in range(width + 2):
+        right = prev[i] if i < width else 0
+        out[i] = (number >> ((left << 2) | (center << 1) | right)) & 1
+        left = center
+        center = right
+
+@njit(cache=True)
+def _set_bit(packed, x, y):
+    packed[y, x >> 3] |= 1 << (x & 7)
+
+# The number of wedge rows grown before they are rotated into the grid.
+TILE_ROWS = 64
+
+@njit(cache=True)
+def _fold_tile(tile, start, out):
+    '''Rotates the wedge rows held in `tile`, the first of which is row
+    `start`, four times into the square `out`.'''
+    center = out.shape[0] // 2
+    rows = tile.shape[0]
+    # Two rotations turn each wedge row into a row of the grid...
+    for r in range(rows):
+        index = start + r
+        for i in range(index * 2 + 1):
+            if tile[r, i]:
+                raw_y = i - index
+                _set_bit(out, center - raw_y, center + index)
+                _set_bit(out, center + raw_y, center - index)
+    # ...and two turn it into a column. Walking the grid a row at a time
+    # keeps those writes to the few bytes the tile's columns cover.
+    last = start + rows - 1
+    for raw_y in range(-last, last + 1):
+        for r in range(rows):
+            index = start + r
+            if -index <= raw_y <= index and tile[r, raw_y + index]:
+                _set_bit(out, center + index, center + raw_y)
+                _set_bit(out, center - index, center - raw_y)
+
+@njit(cache=True)
+def build_grid(number, keep, out):
+    '''Grows the wedge of Wolfram rule `number` and writes it, rotated
+    four times, into the square `out`. The wedge is grown `TILE_ROWS`
+    rows at a time and each tile is rotated into the grid before the next
+    one is grown, so the whole wedge is never held. `out` is bit-packed
+    like `Grid.packed`. Unless `keep` is `None`, each row is masked by
+    the matching row of `keep`, an `(n, 2n - 1)` uint8 array.'''
+    size = out.shape[0]
+    n = (size + 1) // 2
+    tile = np.zeros((TILE_ROWS, size), dtype=np.uint8)
+    # The last row of the previous tile.
+    prev = np.zeros(size, dtype=np.uint8)
+    for start in range(0, n, TILE_ROWS):
+        rows = min(TILE_ROWS, n - start)
+        for r in range(rows):
+            index = start + r
+            if index == 0:
+                tile[0, 0] = 1
+                continue
+            above = tile[r - 1] if r else prev
+            _step(above[:index * 2 - 1], tile[r, :index * 2 + 1], number)
+            if keep is not None:
+                tile[r, :index * 2 + 1] &= keep[index, :index * 2 + 1]
+        prev[:] = tile[rows - 1]
+        _fold_tile(tile[:rows], start, out)
+
+# Wedges at least this many rows long are grown on the GPU, if there is one.
+CUDA_MIN_ROWS = 1024
+
+# The number of threads in each block of a row step launched on the GPU.
+CUDA_BLOCK_SIZE = 256
+
+@cuda.jit
+def _step_cuda(prev, width, number, keep, out):
+    '''Computes one cell of the row below `prev`, `width` cells wide, per
+    thread, masking it with the matching cell of `keep`.'''
+    i = cuda.grid(1)
+    if i < width + 2:
+        left = prev[i - 2] if i >= 2 else 0
+        center = prev[i - 1] if 1 <= i <= width else 0
+        right = prev[i] if i < width else 0
+        out[i] = ((number >> ((left << 2) | (center << 1) | right)) & 1
+                  & keep[i])
+
+def build_grid_cuda(number, keep, out):
+    '''Fills the square `out` like `build_grid` does, growing the wedge of
+    Wolfram rule `number` on the GPU with one launch per row. The wedge
+    stays on the device until it is finished, then is copied back once
+    and rotated into `out` on the host.'''
+    size = out.shape[0]
+    n = (size + 1) // 2
+    if keep is None:
+        keep = np.ones((n, size), dtype=np.uint8)
+    wedge = np.zeros((n, size), dtype=np.uint8)
+    wedge[0, 0] = 1
+    device_wedge = cuda.to_device(wedge)
+    device_keep = cuda.to_device(keep)
+    for index in range(1, n):
+        width = index * 2 - 1
+        blocks = (width + 2 + CUDA_BLOCK_SIZE - 1) // CUDA_BLOCK_SIZE
+        _step_cuda[blocks, CUDA_BLOCK_SIZE](
+            device_wedge[index - 1], width, number,
+            device_keep[index], device_wedge[index])
+    device_wedge.copy_to_host(wedge)
+    for start in range(0, n, TILE_ROWS):
+        _fold_tile(wedge[start:start + TILE_ROWS], start, out)
+
+@njit(parallel=True, nogil=True, cache=True)
+def compute_grids(number, keeps, out):
+    '''Fills the square `out[k]` like `build_grid` does with `keeps[k]`.
+    The grids are independent, so they are spread across threads.'''
+    for k in prange(out.shape[0]):
+        if keeps is None:
+            build_grid(number, None, out[k])
+        else:
+            build_grid(number, keeps[k], out[k])
+
+# A rule pairs a Wolfram rule number with the probability that a cell the
+# rule colours black is left white instead.
+Rule = collections.namedtuple('Rule', ['number', 'flip_prob'])
 
 class Rules(object):
     '''Contains a variety of rules that determines if a cell should turn black 
-    based on the cells in the row above. Each function is namespaced inside 
-    the 'Rules' class for convenience.
+    based on the cells in the row above. Each rule is a `Rule`, namespaced
+    inside the 'Rules' class for convenience.
+
+    Rows are `numpy.uint8` arrays of 0s and 1s. A rule is identified by
+    its Wolfram rule number, whose bits are the entries of its lookup
+    table. Wherever a rule is expected, a bare rule number may be given
+    instead.
     '''
-    rule150Black = (
-        [True, False, False],
-        [False, True, False],
-        [False, False, True],
-        [True, True, True]
-    )
     @staticmethod
-    def rule150(above):
-        '''Colors a cell black if there is an odd number of black cells 
-        above it.'''
-        return above in Rules.rule150Black
+    def table(lut, flip_prob=0.0):
+        '''Returns a rule which follows an 8-entry lookup table in
+        Wolfram's encoding, such as `RULE150_LUT`.'''
+        cells = list(lut)
+        if len(cells) != 8 or any(cell not in (0, 1) for cell in cells):
+            raise ValueError('lookup table must have 8 entries of 0 or 1, '
+                             'not {0!r}'.format(lut))
+        number = sum(int(cell) << i for i, cell in enumerate(cells))
+        return Rule(number, flip_prob)
 
-    @staticmethod
-    def rule150randomized(above):
-        '''Colors a cell black if there's an odd number of black cells above it 
-        (although this rule will be ignored 0.05% of the time.'''
-        if above in Rules.rule150Black:
-            return random.randint(0, 2000) != 0
-        else:
-            return False
+    # Colors a cell black if there is an odd number of black cells above
+    # it.
+    rule150 = Rule(150, 0.0)
+
+    # Colors a cell black if there's an odd number of black cells above it
+    # (although this rule will be ignored 0.05% of the time).
+    rule150randomized = Rule(150, 1.0 / 2001)
 
 class Generator(object):
     '''An object which generates a single wedge based on an initial seed
-    and a rule. If the seed is `None`, a random one will be generated.'''
+    and a rule. If the seed is `None`, a random one will be generated.
+    The rule may also be given as a bare Wolfram rule number.'''
     def __init__(self, seed=None, rule=Rules.rule150):
+        if not isinstance(rule, Rule):
+            rule = Rule(rule, 0.0)
+        if isinstance(rule.number, bool):
+            raise TypeError('rule number must be an integer, not bool')
+        number = operator.index(rule.number)
+        if not 0 <= number <= 255:
+            raise ValueError('rule number must be between 0 and 255, '
+                             'not {0}'.format(number))
         self.seed = seed
-        self.rule = rule
+        self.rule = Rule(number, rule.flip_prob)
 
     def _generate_seed(self, seed=None):
         '''Takes a seed and converts it into an integer.
         If the seed is `None`, a random seed based on system time
-        will be generated.'''
-        to_int = lambda item : int(''.join([str(ord(x)) for x in str(item)]))
+        will be generated. Seeds which aren't integers are hashed
+        into a 64-bit integer.'''
         if seed is None:
-            return to_int(time.time())
-        elif type(seed) in (int, long):
+            seed = time.time_ns()
+        elif isinstance(seed, int):
             return seed
-        else:
-            return to_int(seed)
-
-    def _calculate_row(self, previous_row):
-        '''Generates the next row based on the previous row.'''
-        def _above(row):
-            previous_row = [False, False]
-            previous_row.extend(row)
-            previous_row.extend([False, False])
-            for i in range(len(previous_row) - 2):
-                yield previous_row[i: i+3]
-            
-        return [self.rule(i) for i in _above(previous_row)]
+        digest = hashlib.blake2b(str(seed).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def _random(self, seed):
+        '''Returns the generator which draws the rule's flips for `seed`.
+        NumPy only takes non-negative seeds, so a negative seed is given
+        as `-seed` with a spawn key, which no integer seed can match.'''
+        if seed < 0:
+            seed = np.random.SeedSequence(-seed, spawn_key=(0,))
+        return np.random.default_rng(seed)
+
+    def _draw_keep(self, seed, n):
+        '''Draws, in one batch, the cells of an n-row wedge which the
+        rule's flips leave alone: an `(n, 2n - 1)` uint8 array in which
+        each cell is 0 with probability `flip_prob`, and 1 otherwise.
+        Returns `None` if the rule never flips.
+
+        Rows 1 onwards take their `2i + 1` cells, in order, from one
+        stream of draws, so the mask for a shorter wedge is a prefix of
+        the mask for a longer one, and `generate()` can keep drawing the
+        same stream a row at a time.'''
+        if not self.rule.flip_prob:
+            return None
+        rows = np.arange(n)[:, None]
+        cells = (np.arange(n * 2 - 1) < rows * 2 + 1) & (rows > 0)
+        keep = np.ones((n, n * 2 - 1), dtype=np.uint8)
+        draws = self._random(seed).random(n * n - 1)
+        keep[cells] = draws >= self.rule.flip_prob
+        return keep
+
+    def _calculate_row(self, previous_row, out=None, keep=None):
+        '''Generates the next row based on the previous row, writing it
+        into `out` if given and masking it with `keep` if given.'''
+        if out is None:
+            out = np.empty(previous_row.size + 2, dtype=np.uint8)
+        _step(previous_row, out, self.rule.number)
+        if keep is not None:
+            out &= keep
+        return out
         
     def generate(self, n=None):
-        '''Yields n rows.'''
-        row = [True]
-        yield row
+        '''Yields n rows. When n is given, the rows are views into a
+        single preallocated wedge.'''
+        seed = self._generate_seed(self.seed)
         if n == None:
+            random = self._random(seed)
+            row = np.ones(1, dtype=np.uint8)
+            yield row
             while True:
-                row = self._calculate_row(row) 
+                keep = None
+                if self.rule.flip_prob:
+                    draws = random.random(row.size + 2)
+                    keep = (draws >= self.rule.flip_prob).view(np.uint8)
+                row = self._calculate_row(row, keep=keep) 
                 yield row
         else:
-            for i in xrange(n - 1):
-                row = self._calculate_row(row)
+            wedge = np.empty((n, n * 2 - 1), dtype=np.uint8)
+            keep = self._draw_keep(seed, n)
+            row = wedge[0, :1]
+            row[0] = 1
+            yield row
+            for i in range(1, n):
+                row = self._calculate_row(
+                    row, wedge[i, :i * 2 + 1],
+                    None if keep is None else keep[i, :i * 2 + 1])
                 yield row
 
     def create_grid(self, n):
@@ -84,33 +279,87 @@ class Generator(object):
         The generated wedge will be `n` rows long, yielding
         a square of size `n * 2 - 1`'''
         size = n * 2 - 1
-        grid = Grid(size, size)
-        # Takes raw coordinates and returns new ones 
-        # based on the center of the grid.
-        center_x = grid.center[0]
-        center_y = grid.center[1]
-
-        grid.seed = self._generate_seed(self.seed)
-        random.seed(grid.seed)
-        
-        for index, row in enumerate(self.generate(n)):
-            for i, cell in enumerate(row):
-                if cell:  
-                    raw_x = index
-                    raw_y = i - index
-                    # Rotates a wedge four times to form a square.
-                    grid.set(center_x + raw_x, center_y + raw_y)
-                    grid.set(center_x - raw_x, center_y - raw_y)
-                    grid.set(center_x - raw_y, center_y + raw_x)
-                    grid.set(center_x + raw_y, center_y - raw_x)
+        grid = Grid(size, size, self._generate_seed(self.seed))
+        keep = self._draw_keep(grid.seed, n)
+        if n >= CUDA_MIN_ROWS and cuda.is_available():
+            build_grid_cuda(self.rule.number, keep, grid.packed)
+        elif _build_native is not None:
+            _build_native(self.rule.number, keep, grid.packed)
+        else:
+            build_grid(self.rule.number, keep, grid.packed)
         return grid
 
+    def create_grids(self, n, count, base=None):
+        '''Returns `count` grids like `create_grid`, building them in
+        parallel. The grids are given consecutive seeds, starting from
+        `base` if it is given.'''
+        size = n * 2 - 1
+        if base is None:
+            base = self._generate_seed(self.seed)
+        grids = [Grid(size, size, base + k) for k in range(count)]
+        keeps = None
+        if self.rule.flip_prob:
+            keeps = np.stack([self._draw_keep(grid.seed, n)
+                              for grid in grids])
+        packed = np.zeros((count,) + grids[0].packed.shape, dtype=np.uint8)
+        if n >= CUDA_MIN_ROWS and cuda.is_available():
+            # Each grid this size already fills the GPU, so they are built
+            # one after another.
+            for k in range(count):
+                build_grid_cuda(self.rule.number,
+                                None if keeps is None else keeps[k],
+                                packed[k])
+        elif _build_native is not None:
+            # The C build releases the GIL, so threads run it in parallel.
+            def build(k):
+                _build_native(self.rule.number,
+                              None if keeps is None else keeps[k], packed[k])
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                list(executor.map(build, range(count)))
+        else:
+            compute_grids(self.rule.number, keeps, packed)
+        for grid, bits in zip(grids, packed):
+            grid.packed = bits
+        return grids
+
+    def pool(self, n, size=4):
+        '''Yields grids forever, with consecutive seeds. A background
+        thread keeps up to `size` grids ready, so there is usually no wait
+        for the next one. If the thread fails, its error is raised here.'''
+        base = self._generate_seed(self.seed)
+        # The first batch is built on this thread: numba's TBB threading
+        # layer hangs at exit if its first parallel region ran elsewhere.
+        first = self.create_grids(n, size, base)
+        grids = queue.Queue(maxsize=size)
+        def fill(base):
+            try:
+                while True:
+                    for grid in self.create_grids(n, size, base):
+                        grids.put(grid)
+                    base += size
+            except Exception as error:
+                grids.put(error)
+        worker = threading.Thread(target=fill, args=(base + size,))
+        worker.daemon = True
+        worker.start()
+        for grid in first:
+            yield grid
+        while True:
+            grid = grids.get()
+            if isinstance(grid, Exception):
+                raise grid
+            yield grid
+
     def __call__(self, *args, **kwargs):
         '''A convenience function to create a grid.'''
         return self.create_grid(*args, **kwargs)
 
 class Grid(object):
-    '''An object which holds an arbitrary grid of pixels.'''
+    '''An object which holds an arbitrary grid of pixels.
+
+    Pixels are stored one bit each in `packed`, a row-major `numpy.uint8`
+    array with `ceil(width / 8)` bytes per row; pixel `x` of a row is bit
+    `x & 7` of byte `x >> 3`. `array` unpacks it to one byte per pixel.'''
     def __init__(self, x, y, seed=None):
         self.width = x
         self.height = y
@@ -118,15 +367,36 @@ class Grid(object):
         # The seed used to generate the grid.
         self.seed = seed
         
-        self.array = []
-        for i in xrange(self.height):
-            self.array.append([False for i in xrange(self.width)])
+        self.packed = np.zeros((self.height, (self.width + 7) >> 3),
+                               dtype=np.uint8)
+        # The columns of the live pixels in each row, or `None` if they
+        # have not been indexed since the grid last changed.
+        self.row_live_cols = None
+
+    @property
+    def array(self):
+        '''The pixels as a `(height, width)` uint8 array of 0s and 1s. It
+        is unpacked from `packed` on each access and is read-only; use
+        `set` to change a pixel.'''
+        array = np.unpackbits(self.packed, axis=1, count=self.width,
+                              bitorder='little')
+        array.flags.writeable = False
+        return array
     
     def get(self, x, y):
-        return self.array[y][x]
+        return (self.packed[y, x >> 3] >> (x & 7)) & 1
+
+    def index_live_cols(self):
+        '''Records the columns of the live pixels in each row, so that
+        sparse grids can be drawn without scanning every pixel.'''
+        self.row_live_cols = [np.flatnonzero(row) for row in self.array]
 
-    def set(self, x, y, value=True):
-        self.array[y][x] = value
+    def set(self, x, y, value=1):
+        self.row_live_cols = None
+        if value:
+            self.packed[y, x >> 3] |= 1 << (x & 7)
+        else:
+            self.packed[y, x >> 3] &= ~(1 << (x & 7)) & 0xff
 
 class PygameRenderer(object):
     '''Renders a grid object using Pygame, and also contains code to
@@ -151,23 +421,52 @@ class PygameRenderer(object):
         self.surface = pygame.display.get_surface()
 
     def _configure_graphics(self):
-        self.tile = pygame.Surface((self.pixel_size, self.pixel_size))
-        self.tile.fill(self.foreground)
+        # Maps a cell's value to its RGB colour.
+        self.colors = np.array([self.background, self.foreground],
+                               dtype=np.uint8)
+        # One cell per pixel can be written straight into the display's
+        # pixels as mapped colours, which needs a 1, 2 or 4 byte format.
+        self.mapped_colors = None
+        if self.pixel_size == 1 and self.surface.get_bytesize() != 3:
+            self.mapped_colors = np.array(
+                [self.surface.map_rgb(self.background),
+                 self.surface.map_rgb(self.foreground)],
+                dtype=np.uint32)
         
     def render(self, grid):
-        '''Renders the grid, and prints the current seed to stdout.'''
+        '''Renders the grid, and prints the current seed to stdout.
+        With one pixel per cell the whole frame is copied to the screen
+        at once; larger cells are drawn as one rectangle per run of live
+        cells in a row.'''
         self.grid = grid
-        self.surface.fill(self.background)
-        for x, column in enumerate(self.grid.array):
-            x_cell = x * self.pixel_size
-            for y, cell in enumerate(column):
-                if cell:
-                    self.surface.blit(
-                        self.tile,
-                        (x_cell, y * self.pixel_size)
-                    )
+        if self.pixel_size > 1:
+            self._fill_runs()
+        else:
+            # Surface arrays are indexed by (x, y), the grid by (y, x).
+            cells = self.grid.array.T
+            if self.mapped_colors is not None:
+                pixels = pygame.surfarray.pixels2d(self.surface)
+                pixels[:] = self.mapped_colors[cells]
+                # Unlocks the surface again.
+                del pixels
+            else:
+                pygame.surfarray.blit_array(self.surface, self.colors[cells])
         pygame.display.flip()
-        print self.grid.seed
+        print(self.grid.seed)
+
+    def _fill_runs(self):
+        if self.grid.row_live_cols is None:
+            self.grid.index_live_cols()
+        size = self.pixel_size
+        self.surface.fill(self.background)
+        for y, cols in enumerate(self.grid.row_live_cols):
+            if not cols.size:
+                continue
+            # Splits the live columns wherever they stop being adjacent.
+            breaks = np.flatnonzero(np.diff(cols) != 1) + 1
+            for run in np.split(cols, breaks):
+                self.surface.fill(self.foreground, (run[0] * size, y * size,
+                                                    run.size * size, size))
 
     def wait(self):
         while True:
@@ -196,21 +495,21 @@ class PygameRenderer(object):
         
 class AsciiRenderer(object):
     '''Creates an ASCII version of the grid.'''
+    # Maps a cell's value to its character.
+    chars = np.frombuffer(b' #', dtype=np.uint8)
+
     def to_string(self, grid):
-        out = []
-        for x in xrange(grid.width):
-            row = ['[']
-            for y in xrange(grid.height):
-                if grid.get(x, y):
-                    row.append('#')
-                else:
-                    row.append(' ')
-            row.append(']')
-            out.append(''.join(row))
-        return '\n'.join(out)
+        '''Returns one bracketed line per row of the grid. All the lines
+        are built in a single byte array and decoded at once.'''
+        lines = np.empty((grid.height, grid.width + 3), dtype=np.uint8)
+        lines[:, 0] = ord('[')
+        lines[:, 1:-2] = self.chars[grid.array]
+        lines[:, -2] = ord(']')
+        lines[:, -1] = ord('\n')
+        return lines.tobytes()[:-1].decode('ascii')
         
-    def render(self):
-        print self.to_string()
+    def render(self, grid):
+        print(self.to_string(grid))
     
 
 def test_rows(n=5):
@@ -219,7 +518,7 @@ def test_rows(n=5):
     for index, row in enumerate(g.generate(n)):
         padding = " " * (n - index - 1)
         out = "[{0}{1}{0}]"
-        print out.format(padding, "".join("#" if n else " " for n in row))
+        print(out.format(padding, "".join("#" if n else " " for n in row)))
 
 def test_grid(n = 5, pixel_size = 16, rule=Rules.rule150):
     '''Creates a normal grid.'''
@@ -231,11 +530,11 @@ def test_grid(n = 5, pixel_size = 16, rule=Rules.rule150):
 
 def test_grid_randomized(n=256, pixel_size=1, rule=Rules.rule150randomized):
     '''Creates a randomized grid, and will repeatedly create a new one.'''
-    g = Generator(rule=rule)
+    grids = Generator(rule=rule).pool(n)
     r = PygameRenderer(n, pixel_size)
 
     while True:
-        grid = g(n)
+        grid = next(grids)
         r.render(grid)
         r.refresh()
 